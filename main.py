@@ -1,19 +1,27 @@
 # main.py
 
 from math import floor
-from fastapi import Depends, FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi import Depends, FastAPI, HTTPException, BackgroundTasks, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, Response
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles # StaticFiles 임포트
 import uvicorn
 from pydantic import BaseModel
 from services.gemini_service import *
 from services.admin_service import *
+from services.run_journal import RunJournal
+from services.sprite_service import find_atlas, get_run_atlas
+from services.image_store import IMMUTABLE_CACHE_CONTROL, IMAGE_URL_PREFIX, etag_matches, find_image, release_image
+from services.tracing import annotate, arm_profile, bind_context, get_profile, list_profiles, new_request_id, span, traced
+import asyncio
+import hashlib
 import json
+import orjson
 import os
 from security.admin_auth import get_current_admin_user
 from models import *
 import secrets
+import time
 import logging # 로깅 모듈 임포트
 from logging.handlers import RotatingFileHandler # 로그 파일 관리를 위해 임포트
 
@@ -28,7 +36,8 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 # -------------------------
 
-app = FastAPI()
+# 기본 JSON 인코더 대신 orjson으로 응답을 직렬화합니다.
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # --- 로깅 미들웨어 (수정됨) ---
 @app.middleware("http")
@@ -37,7 +46,7 @@ async def log_requests(request: Request, call_next):
     html_paths_to_skip_log = ["/", "/run-test", "/test", "/admin"]
 
     # 요청 경로가 위 목록에 있거나 .html로 끝나면 로깅을 건너뜁니다.
-    if request.url.path in html_paths_to_skip_log or request.url.path.endswith(".html") or request.url.path.startswith("/api/admin") or request.url.path.startswith("/static"):
+    if request.url.path in html_paths_to_skip_log or request.url.path.endswith(".html") or request.url.path.startswith("/api/admin") or request.url.path.startswith("/static") or request.url.path.startswith("/images") or request.url.path.startswith("/atlases"):
         response = await call_next(request)
         return response
 
@@ -66,6 +75,19 @@ async def log_requests(request: Request, call_next):
     return Response(content=response_body, status_code=response.status_code, headers=dict(response.headers))
 # -------------------------
 
+# --- 트레이싱 미들웨어 ---
+# 요청마다 request_id를 부여하고 최상위 스팬을 엽니다.
+# 핸들러, 백그라운드 작업, LLM 호출, 파일 I/O 스팬은 모두 이 스팬의 자식으로 기록됩니다.
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    with span(f"{request.method} {request.url.path}", request_id=request_id) as request_span:
+        response = await call_next(request)
+        request_span.set(status_code=response.status_code)
+    response.headers["X-Request-ID"] = request_id
+    return response
+# -------------------------
+
 # CORS 미들웨어 설정
 # 웹 브라우저에서 실행되는 test.html이 API 서버에 요청을 보낼 수 있도록 허용합니다.
 origins = [
@@ -79,12 +101,43 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"], # 모든 HTTP 메소드 허용
     allow_headers=["*"], # 모든 HTTP 헤더 허용
+    # 다른 출처의 클라이언트도 페이지네이션 커서, ETag, 요청 ID 헤더를 읽을 수 있도록 노출합니다.
+    expose_headers=["X-Next-Cursor", "ETag", "X-Request-ID"],
 )
 
 CHARACTER_FILE = os.getenv("CHARACTER_FILE")
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# CDN과 캐시 검증기가 보내는 HEAD 요청에도 같은 헤더로 응답합니다.
+@app.api_route("/images/{filename}", methods=["GET", "HEAD"])
+def get_stored_image(filename: str, request: Request):
+    """
+    내용 해시로 저장된 이미지를 반환합니다. 이름이 곧 내용이므로 immutable로 영구 캐시하고,
+    ETag가 일치하는 조건부 요청에는 304를 반환합니다.
+    """
+    found = find_image(f"{IMAGE_URL_PREFIX}{filename}", request.headers.get("accept", ""))
+    if found is None:
+        raise HTTPException(status_code=404, detail="이미지를 찾을 수 없습니다.")
+    path, media_type, etag = found
+    return immutable_file_response(request, path, media_type, {"ETag": etag, "Vary": "Accept"})
+
+@app.api_route("/atlases/{filename}", methods=["GET", "HEAD"])
+def get_atlas_image(filename: str, request: Request):
+    """Run 아틀라스 이미지를 반환합니다. 파일 이름이 적 조합에서 나오므로 /images와 같이 영구 캐시합니다."""
+    found = find_atlas(filename)
+    if found is None:
+        raise HTTPException(status_code=404, detail="아틀라스를 찾을 수 없습니다.")
+    path, media_type, etag = found
+    return immutable_file_response(request, path, media_type, {"ETag": etag})
+
+def immutable_file_response(request: Request, path: str, media_type: str, headers: dict):
+    """immutable 캐시 헤더를 붙여 파일을 반환하고, ETag가 일치하는 조건부 요청에는 304를 반환합니다."""
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, **headers}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
 @app.post("/api/v1/characters")
 def handle_create_character(request: CharacterCreateRequest):
     character_data = create_character(request.user_prompt)
@@ -111,9 +164,45 @@ if __name__ == "__main__":
 # --- admin API endpoint ---
 
 @app.get("/api/admin/characters")
-def get_characters_list(username: str = Depends(get_current_admin_user)):
-    """저장된 모든 캐릭터 목록을 반환합니다."""
-    return get_all_characters_from_file()
+def get_characters_list(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    username: str = Depends(get_current_admin_user)
+):
+    """
+    저장된 캐릭터 목록을 반환합니다. (파라미터가 없으면 전체 목록)
+    - limit / cursor: 커서 기반 페이지네이션. 다음 페이지 커서는 X-Next-Cursor 헤더로 전달됩니다.
+    - fields: 필요한 필드만 반환 (예: fields=id,character_name,image_url)
+    목록 ETag는 캐릭터 풀 세대에 묶여 있어, 풀이 바뀌지 않았다면 304를 반환합니다.
+    """
+    pool = get_character_pool()
+    characters, blobs = pool["characters"], pool["blobs"]
+
+    query_key = f"{limit}|{cursor}|{fields}"
+    etag = f'"{pool["generation"]}-{hashlib.sha256(query_key.encode("utf-8")).hexdigest()[:8]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    start = 0
+    if cursor:
+        start = next((i + 1 for i, char in enumerate(characters) if char.get('id') == cursor), None)
+        if start is None:
+            raise HTTPException(status_code=400, detail="유효하지 않거나 만료된 cursor입니다. 처음부터 다시 조회해주세요.")
+    end = len(characters) if limit is None else min(start + limit, len(characters))
+
+    if fields:
+        field_names = [name.strip() for name in fields.split(",") if name.strip()]
+        content = orjson.dumps([{name: char[name] for name in field_names if name in char} for char in characters[start:end]])
+    else:
+        # 미리 직렬화해 둔 캐릭터별 JSON 바이트를 이어 붙입니다.
+        content = b"[" + b",".join(blobs[start:end]) + b"]"
+
+    if end < len(characters) and end > start:
+        headers["X-Next-Cursor"] = characters[end - 1].get('id') or ""
+    return Response(content=content, media_type="application/json", headers=headers)
 
 @app.post("/api/admin/characters")
 def handle_create_character_and_save(request: CharacterCreateRequest, username: str = Depends(get_current_admin_user)):
@@ -144,28 +233,88 @@ def handle_delete_character(character_id: str, username: str = Depends(get_curre
     return {"message": "캐릭터가 성공적으로 삭제되었습니다."}
 
 
+# --- admin 프로파일링 API ---
+
+@app.post("/api/admin/profile")
+def handle_arm_profile(request: ProfileRequest, username: str = Depends(get_current_admin_user)):
+    """
+    지정한 스팬 이름(예: "get_floor_data", "calculate_floor_chart", "llm.generate_content")의
+    다음 실행 한 번을 프로파일링하도록 예약합니다. 결과는 profile_id로 조회합니다.
+    """
+    try:
+        return arm_profile(request.target, request.mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/admin/profile")
+def get_profiles_list(username: str = Depends(get_current_admin_user)):
+    """최근 프로파일링 예약 및 보고서 목록을 반환합니다."""
+    return list_profiles()
+
+@app.get("/api/admin/profile/{profile_id}")
+def get_profile_report(profile_id: str, username: str = Depends(get_current_admin_user)):
+    """프로파일링 상태와 보고서를 반환합니다."""
+    profile = get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="해당 ID의 프로파일링 기록을 찾을 수 없습니다.")
+    return profile
+
+
 @app.get("/run-test")
 def get_run_test_page():
     return FileResponse("run_test.html")
 
 # --- 인메모리 DB: 진행 중인 게임 저장 ---
-runs_db = {} # { "run_id": { "status": "calculating" | "completed", "data": {...} } }
+# 재시작(배포, --reload) 후에도 진행 중인 Run이 유지되도록 저널에서 복구합니다.
+run_journal = RunJournal()
+runs_db = run_journal.load() # { "run_id": { "status": "calculating" | "completed", "data": {...} } }
+# 층 상성표 계산이 실패하거나 미완성으로 끝났을 때의 재시도 제한.
+# 대기 시간은 실패할 때마다 두 배로 늘어나고, 횟수를 넘기면 그 층은 'failed' 상태가 됩니다.
+TYPE_CHART_MAX_ATTEMPTS = int(os.getenv("TYPE_CHART_MAX_ATTEMPTS", "3"))
+TYPE_CHART_RETRY_BACKOFF_SECONDS = float(os.getenv("TYPE_CHART_RETRY_BACKOFF_SECONDS", "10"))
+# 방치된 Run을 정리하는 주기 (초)
+RUN_EVICT_INTERVAL_SECONDS = int(os.getenv("RUN_EVICT_INTERVAL_SECONDS", "600"))
+
+@app.on_event("startup")
+async def requeue_pending_floor_charts():
+    """재시작 직전에 계산 중이던 층의 상성표 계산을 다시 큐에 넣습니다."""
+    loop = asyncio.get_running_loop()
+    for run_id, floor_number in run_journal.pending_floors():
+        run_data = runs_db[run_id]["data"]
+        print(f"[{run_id}] {floor_number}층 상성표 계산 재시작")
+        loop.run_in_executor(None, calculate_floor_chart, run_id, run_data["player_characters"], run_data["enemies"][floor_number - 1], floor_number)
+
+@app.on_event("startup")
+async def start_idle_run_eviction():
+    """/complete 없이 버려진 Run이 runs_db와 스냅샷에 계속 쌓이지 않도록 주기적으로 정리합니다."""
+    async def evict_loop():
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(RUN_EVICT_INTERVAL_SECONDS)
+            await loop.run_in_executor(None, run_journal.evict_idle_runs)
+    asyncio.create_task(evict_loop())
 # --- 신규 게임 API 엔드포인트 ---
 
 @app.post("/api/runs")
+@traced()
 def handle_create_run(request: RunCreateRequest, background_tasks: BackgroundTasks):
     """
     새로운 게임(Run)을 시작합니다. 적 목록을 즉시 반환하고,
     상성표 계산은 백그라운드에서 순차적으로 처리합니다.
     """
     run_id = f"run_{uuid.uuid4()}"
+    annotate(run_id=run_id)
     
-    all_enemies_pool = get_all_characters_from_file()
+    pool = get_character_pool()
+    all_enemies_pool = pool["characters"]
     if not all_enemies_pool or len(all_enemies_pool) < 9:
         raise HTTPException(status_code=500, detail="적이 9명 미만이라 게임을 시작할 수 없습니다. admin 페이지에서 캐릭터를 생성해주세요.")
     
     import random
-    enemies = random.sample(all_enemies_pool, 9)
+    enemy_indices = random.sample(range(len(all_enemies_pool)), 9)
+    enemies = [all_enemies_pool[i] for i in enemy_indices]
+    # 풀에서 미리 직렬화해 둔 적 JSON 바이트를 그대로 재사용합니다.
+    enemy_blobs = [pool["blobs"][i] for i in enemy_indices]
     player_characters_dict = [char.dict(by_alias=True) for char in request.player_characters]
 
     # Run 데이터 초기 상태로 저장
@@ -175,56 +324,93 @@ def handle_create_run(request: RunCreateRequest, background_tasks: BackgroundTas
             "enemies": enemies,
             "type_charts": {}, # 비어있는 딕셔너리로 시작
             "calculation_triggered": {}
-        }
+        },
+        "enemy_blobs": enemy_blobs
     }
+    run_journal.touch(runs_db[run_id])
+    run_journal.record_run_created(run_id, player_characters_dict, enemies)
 
-    background_tasks.add_task(calculate_floor_chart, run_id, player_characters_dict, enemies[0], 1)
+    background_tasks.add_task(bind_context(calculate_floor_chart), run_id, player_characters_dict, enemies[0], 1)
 
     # 백그라운드에서 전체 상성표 계산 작업 시작
     # background_tasks.add_task(calculate_all_floor_charts_task, run_id, player_characters_dict, enemies)
     
     # 적 목록과 run_id를 즉시 반환
     print(f"[{run_id}] 게임 시작. 1층 적 목록 백그라운드에서 진행 중")
-    return {"run_id": run_id, "enemies": enemies}
+    content = b'{"run_id":' + orjson.dumps(run_id) + b',"enemies":[' + b",".join(enemy_blobs) + b"]}"
+    return Response(content=content, media_type="application/json")
 
 @app.get("/api/runs/{run_id}/floors/{floor_number}")
+@traced()
 def get_floor_data(run_id: str, floor_number: int, background_tasks: BackgroundTasks):
     """
     특정 층의 정보와 상성표를 반환합니다.
     해당 층의 상성표가 아직 계산 중이면 'calculating' 상태를 반환합니다.
     """
+    annotate(run_id=run_id, floor=floor_number)
     run_session = runs_db.get(run_id)
     if not run_session:
         raise HTTPException(status_code=404, detail="해당 Run을 찾을 수 없습니다.")
+    run_journal.touch(run_session)
     
     # --- (수정된 핵심 로직) ---
     # 1. 층 번호를 문자열 키로 변환합니다.
     floor_key = str(floor_number)
     
-    # 2. 해당 층의 상성표가 'type_charts' 딕셔너리 안에 있는지 직접 확인합니다.
-    if floor_key not in run_session["data"]["type_charts"]:
-        return {"status": "calculating"} # 아직 계산 중
-    # --------------------------------
-
     run_data = run_session["data"]
     if not (1 <= floor_number <= 9):
         raise HTTPException(status_code=400, detail="층 번호는 1에서 9 사이여야 합니다.")
+
+    # 2. 해당 층의 상성표가 'type_charts' 딕셔너리 안에 있는지 직접 확인합니다.
+    if floor_key not in run_data["type_charts"]:
+        attempt = run_data.get("chart_attempts", {}).get(floor_number)
+        if attempt and attempt["count"] >= TYPE_CHART_MAX_ATTEMPTS:
+            return {"status": "failed"} # 재시도 횟수를 모두 써서 더 이상 계산하지 않습니다.
+        # 이전 계산이 실패했거나 미완성으로 끝났다면(계산 표시가 지워진 상태) 대기 시간이 지난 뒤 다시 계산을 요청합니다.
+        if floor_number not in run_data["calculation_triggered"] and can_retry_floor_chart(run_data, floor_number):
+            background_tasks.add_task(bind_context(calculate_floor_chart), run_id, run_data["player_characters"], run_data["enemies"][floor_number - 1], floor_number)
+        return {"status": "calculating"} # 아직 계산 중
+    # --------------------------------
         
-    enemy_data = run_data["enemies"][floor_number - 1]
+    # 재시작 후 저널에서 복구된 Run은 직렬화된 적 데이터가 없으므로 처음 한 번만 만듭니다.
+    if "enemy_blobs" not in run_session:
+        run_session["enemy_blobs"] = [orjson.dumps(enemy) for enemy in run_data["enemies"]]
+    enemy_blob = run_session["enemy_blobs"][floor_number - 1]
     # 해당 층의 상성표만 정확히 가져옵니다.
     type_chart = run_data["type_charts"][floor_key]
 
     if floor_number < 9:
-        background_tasks.add_task(calculate_floor_chart, run_id, run_data["player_characters"], run_data["enemies"][floor_number], floor_number+1)
+        background_tasks.add_task(bind_context(calculate_floor_chart), run_id, run_data["player_characters"], run_data["enemies"][floor_number], floor_number+1)
+
+    content = b'{"status":"completed","enemy":' + enemy_blob + b',"type_chart":' + orjson.dumps(type_chart) + b"}"
+    return Response(content=content, media_type="application/json")
 
-    return {"status": "completed", "enemy": enemy_data, "type_chart": type_chart}
+@app.get("/api/runs/{run_id}/atlas")
+@traced()
+def get_run_atlas_manifest(run_id: str):
+    """
+    Run의 적 9명 스프라이트를 하나로 묶은 아틀라스 이미지 경로와 좌표 매니페스트를 반환합니다.
+    클라이언트는 적마다 이미지를 따로 요청하는 대신 아틀라스 한 장만 내려받으면 됩니다.
+    """
+    annotate(run_id=run_id)
+    run_session = runs_db.get(run_id)
+    if not run_session:
+        raise HTTPException(status_code=404, detail="해당 Run을 찾을 수 없습니다.")
+    run_journal.touch(run_session)
+
+    manifest = get_run_atlas(run_session["data"]["enemies"])
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="아틀라스로 묶을 적 이미지가 없습니다.")
+    return manifest
 
 @app.post("/api/runs/{run_id}/complete")
+@traced()
 def handle_game_complete(run_id: str, request: GameCompleteRequest):
     """
     게임 클리어를 처리하고, 우승한 캐릭터 3명을 '적 풀'에 저장한 뒤,
     진행 중인 Run 데이터를 삭제합니다.
     """
+    annotate(run_id=run_id)
     # 1. 우승 캐릭터들을 characters.json 파일에 저장합니다.
     winning_characters_dict = [char.dict() for char in request.winning_characters]
     save_characters_to_file(winning_characters_dict)
@@ -232,6 +418,7 @@ def handle_game_complete(run_id: str, request: GameCompleteRequest):
     # 2. 진행이 끝난 Run 데이터를 메모리에서 삭제합니다.
     if run_id in runs_db:
         del runs_db[run_id]
+        run_journal.record_run_completed(run_id)
         print(f"[{run_id}] Run completed and removed from memory.")
         return {"message": "Congratulations! Run complete and characters saved to Hall of Fame."}
     else:
@@ -241,6 +428,7 @@ def handle_game_complete(run_id: str, request: GameCompleteRequest):
     
 
 # --- 여러 캐릭터를 파일에 저장하는 함수 ---
+@traced("file.save_characters")
 def save_characters_to_file(characters_data: List[dict]):
     """우승한 캐릭터 리스트에 '새로운 ID'를 부여하여 JSON 파일에 추가합니다."""
     all_chars = get_all_characters_from_file()
@@ -253,6 +441,7 @@ def save_characters_to_file(characters_data: List[dict]):
     
     with open(CHARACTER_FILE, "w", encoding="utf-8") as f:
         json.dump(all_chars, f, ensure_ascii=False, indent=2)
+    invalidate_character_pool()
     return True
 
 # --- 백그라운드 작업 함수 ---
@@ -276,7 +465,7 @@ def calculate_and_save_type_chart_task(run_id: str, player_characters: List[dict
 
     # 3. 계산 완료 후 Run 데이터 업데이트
     if run_id in runs_db:
-        if flat_type_chart:
+        if flat_type_chart and not flat_type_chart.get("incomplete"):
             # --- (수정) 플랫 리스트를 중첩 딕셔너리로 변환하는 로직 ---
             nested_chart = { "player_vs_enemy": {}, "enemy_vs_player": {} }
             for item in flat_type_chart.get('player_vs_enemy', []):
@@ -323,7 +512,7 @@ def calculate_all_floor_charts_task(run_id: str, player_characters: List[dict],
         )
 
         # 계산 완료 후 Run 데이터에 해당 층의 상성표 추가
-        if run_id in runs_db and type_chart:
+        if run_id in runs_db and type_chart and not type_chart.get("incomplete"):
             # 딕셔너리로 변환하여 저장
             nested_chart = { "player_vs_enemy": {}, "enemy_vs_player": {} }
             for item in type_chart.get('player_vs_enemy', []):
@@ -342,17 +531,37 @@ def calculate_all_floor_charts_task(run_id: str, player_characters: List[dict],
             print(f"[{run_id}] {floor_number}층 상성표 계산 실패. 백그라운드 작업을 중단합니다.")
             break # 실패 시 중단
 
+def can_retry_floor_chart(run_data: dict, floor_number: int) -> bool:
+    """층 상성표 계산의 재시도 횟수가 남아 있고 대기 시간이 지났는지 확인합니다."""
+    attempt = run_data.get("chart_attempts", {}).get(floor_number)
+    if attempt is None:
+        return True
+    return attempt["count"] < TYPE_CHART_MAX_ATTEMPTS and time.time() >= attempt["retry_at"]
+
+def record_floor_chart_failure(run_data: dict, floor_number: int):
+    """실패 횟수를 늘리고 다음 재시도 시각을 지수적으로 늦춥니다."""
+    attempt = run_data.setdefault("chart_attempts", {}).setdefault(floor_number, {"count": 0, "retry_at": 0})
+    attempt["count"] += 1
+    attempt["retry_at"] = time.time() + TYPE_CHART_RETRY_BACKOFF_SECONDS * 2 ** (attempt["count"] - 1)
+    run_data["calculation_triggered"].pop(floor_number, None)
+
+@traced()
 def calculate_floor_chart(run_id: str, player_characters: List[dict], enemy: CharacterData, floor_number: int):
     """
     (백그라운드에서 실행됨) 1층부터 9층까지의 상성표를 순차적으로 계산합니다.
     """
+    annotate(run_id=run_id, floor=floor_number)
     if floor_number < 1 or 9 < floor_number:
         print(f"{floor_number}층은 존재하지 않습니다.")
         return
     if floor_number in runs_db[run_id]["data"]["calculation_triggered"]:
         print(f"{floor_number}층 상성표 계산중..")
         return
+    if not can_retry_floor_chart(runs_db[run_id]["data"], floor_number):
+        print(f"[{run_id}] {floor_number}층 상성표 재시도 대기 중이거나 재시도 횟수를 모두 사용했습니다.")
+        return
     runs_db[run_id]["data"]["calculation_triggered"][floor_number] = True
+    run_journal.record_floor_started(run_id, floor_number)
     print(f"[{run_id}] 백그라운드 작업 시작: {floor_number}층 상성표 계산")
     
     # 이 층에 필요한 타입만 수집
@@ -361,14 +570,23 @@ def calculate_floor_chart(run_id: str, player_characters: List[dict], enemy: Cha
     enemy_skill_types = {skill['skill_type'] for skill in enemy['skills']}
     player_character_types = {char['character_type'] for char in player_characters}
 
-    # LLM으로 상성표 계산
+    # LLM으로 상성표 계산 (이전에 미완성으로 끝났다면 빠진 조합만 요청)
+    partial_charts = runs_db[run_id]["data"].setdefault("partial_charts", {})
     type_chart = calculate_type_chart(
         list(player_skill_types), list(enemy_character_types),
-        list(enemy_skill_types), list(player_character_types)
+        list(enemy_skill_types), list(player_character_types),
+        known_chart=partial_charts.get(str(floor_number))
     )
 
+    if run_id in runs_db and type_chart and type_chart.get("incomplete"):
+        # 빠진 조합을 임의 값으로 채우지 않습니다. 받은 항목만 보관하고 다음 조회 때 나머지를 다시 요청합니다.
+        partial_charts[str(floor_number)] = type_chart
+        record_floor_chart_failure(runs_db[run_id]["data"], floor_number)
+        print(f"[{run_id}] {floor_number}층 상성표 미완성. 대기 시간 후 빠진 조합만 다시 계산합니다.")
     # 계산 완료 후 Run 데이터에 해당 층의 상성표 추가
-    if run_id in runs_db and type_chart:
+    elif run_id in runs_db and type_chart:
+        partial_charts.pop(str(floor_number), None)
+        runs_db[run_id]["data"].get("chart_attempts", {}).pop(floor_number, None)
         # 딕셔너리로 변환하여 저장
         nested_chart = { "player_vs_enemy": {}, "enemy_vs_player": {} }
         for item in type_chart.get('player_vs_enemy', []):
@@ -382,17 +600,23 @@ def calculate_floor_chart(run_id: str, player_characters: List[dict], enemy: Cha
             nested_chart['enemy_vs_player'][attacker][defender] = multiplier
 
         runs_db[run_id]["data"]["type_charts"][str(floor_number)] = nested_chart
+        run_journal.record_floor_chart(run_id, floor_number, nested_chart)
         print(f"[{run_id}] {floor_number}층 상성표 계산 완료 및 저장 성공.")
     else:
+        if run_id in runs_db:
+            record_floor_chart_failure(runs_db[run_id]["data"], floor_number)
         print(f"[{run_id}] {floor_number}층 상성표 계산 실패.")
 
+@traced("file.update_character")
 def update_character_in_file(character_id: str, updated_char_data: dict):
     """ID를 기준으로 캐릭터 데이터를 찾아 업데이트합니다."""
     characters = get_all_characters_from_file()
     
     char_found = False
+    old_image_url = None
     for i, char in enumerate(characters):
         if char.get('id') == character_id:
+            old_image_url = char.get('image_url')
             # ID는 유지하고 나머지 데이터만 업데이트합니다.
             characters[i] = updated_char_data
             characters[i]['id'] = character_id # ID가 바뀌지 않도록 보장
@@ -404,4 +628,9 @@ def update_character_in_file(character_id: str, updated_char_data: dict):
 
     with open(CHARACTER_FILE, "w", encoding="utf-8") as f:
         json.dump(characters, f, ensure_ascii=False, indent=2)
+    invalidate_character_pool()
+
+    # 이미지가 교체되었다면, 더 이상 아무도 참조하지 않는 이전 이미지를 정리합니다.
+    if old_image_url and old_image_url != updated_char_data.get('image_url'):
+        release_image(old_image_url, characters)
     return True
\ No newline at end of file
@@ -0,0 +1,39 @@
+# migrate_images.py
+# 기존 /static/images/image_<uuid>.png 스프라이트를 내용 해시 이미지 저장소(/images/<sha256>.png)로 옮기는 일회성 스크립트.
+# 사용법: python migrate_images.py [characters.json 경로]  (기본값: .env의 CHARACTER_FILE)
+
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from services.image_store import migrate_legacy_image, resolve_image_path
+
+
+def migrate(character_file: str):
+    with open(character_file, "r", encoding="utf-8") as f:
+        characters = json.load(f)
+
+    moved = {}  # { 기존 URL: 새 URL }
+    for char in characters:
+        old_url = char.get('image_url')
+        if old_url not in moved:
+            moved[old_url] = migrate_legacy_image(old_url)
+        if moved[old_url]:
+            char['image_url'] = moved[old_url]
+
+    # characters.json을 먼저 쓴 뒤에 기존 파일을 지웁니다. (중간에 실패해도 참조가 끊기지 않도록)
+    with open(character_file, "w", encoding="utf-8") as f:
+        json.dump(characters, f, ensure_ascii=False, indent=2)
+
+    for old_url, new_url in moved.items():
+        if new_url:
+            os.remove(resolve_image_path(old_url))
+            print(f"이미지 이동: {old_url} -> {new_url}")
+    print(f"이미지 {sum(1 for url in moved.values() if url)}개를 저장소로 옮겼습니다.")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    migrate(sys.argv[1] if len(sys.argv) > 1 else os.getenv("CHARACTER_FILE", "static/characters.json"))
@@ -56,6 +56,17 @@ class CharacterData(BaseModel):
     character_type: str
     skills: List[Skill]
 
+# --- 상성표 모델 (LLM 응답 스키마) ---
+class TypeMatchup(BaseModel):
+    attacker: str
+    defender: str
+    # 상성 계수는 0.00 ~ 2.00 범위여야 합니다. (skill_prompt.txt 규칙 1)
+    multiplier: float = Field(ge=0.0, le=2.0)
+
+class TypeChart(BaseModel):
+    player_vs_enemy: List[TypeMatchup]
+    enemy_vs_player: List[TypeMatchup]
+
 # --- API 요청 모델 ---
 class RunCreateRequest(BaseModel):
     player_characters: List[CharacterData]
@@ -64,4 +75,9 @@ class CharacterCreateRequest(BaseModel):
     user_prompt: str
 
 class GameCompleteRequest(BaseModel):
-    winning_characters: List[CharacterData]
\ No newline at end of file
+    winning_characters: List[CharacterData]
+
+class ProfileRequest(BaseModel):
+    # 프로파일링할 스팬 이름 (예: "get_floor_data", "calculate_floor_chart")
+    target: str
+    mode: str = "cprofile" # "cprofile" | "sampling"
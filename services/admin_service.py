@@ -1,8 +1,59 @@
+import hashlib
 import json
 import os
+import threading
+import orjson
+from services.image_store import release_image
+from services.tracing import traced
 
 CHARACTER_FILE = os.getenv("CHARACTER_FILE")
 
+# --- 읽기 전용 캐릭터 풀 캐시 ---
+# 파일이 바뀌지 않았다면 다시 읽거나 직렬화하지 않고, 캐릭터별로 미리 직렬화한 JSON 바이트를 재사용합니다.
+# { "key": 파일 (mtime, size), "generation": 내용 해시, "characters": [...], "blobs": [캐릭터별 JSON 바이트] }
+_character_pool = {"key": None, "generation": "empty", "characters": [], "blobs": []}
+_character_pool_lock = threading.Lock()
+
+def get_character_pool() -> dict:
+    """
+    캐시된 캐릭터 풀을 반환합니다. 반환된 리스트와 딕셔너리는 여러 요청이 공유하므로 수정하면 안 됩니다.
+    캐릭터를 수정할 때는 get_all_characters_from_file()로 새 리스트를 받아야 합니다.
+    """
+    global _character_pool
+    try:
+        stat = os.stat(CHARACTER_FILE)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except (FileNotFoundError, TypeError):
+        key = None
+
+    with _character_pool_lock:
+        if _character_pool["key"] == key and key is not None:
+            return _character_pool
+        _character_pool = _load_character_pool(key)
+        return _character_pool
+
+@traced("file.load_character_pool")
+def _load_character_pool(key) -> dict:
+    try:
+        with open(CHARACTER_FILE, "rb") as f:
+            raw = f.read()
+        characters = orjson.loads(raw)
+    except (FileNotFoundError, TypeError, orjson.JSONDecodeError):
+        raw, characters = b"", []
+    return {
+        "key": key,
+        # 풀 세대(generation): 목록 ETag로 사용합니다. 내용이 같으면 값도 같습니다.
+        "generation": hashlib.sha256(raw).hexdigest()[:16],
+        "characters": characters,
+        "blobs": [orjson.dumps(char) for char in characters],
+    }
+
+def invalidate_character_pool():
+    """캐릭터 파일을 쓴 직후 호출하여 다음 조회 때 풀을 다시 읽도록 합니다."""
+    with _character_pool_lock:
+        _character_pool["key"] = None
+
+@traced("file.read_characters")
 def get_all_characters_from_file():
     """characters.json 파일에서 모든 캐릭터 목록을 불러옵니다."""
     try:
@@ -11,14 +62,17 @@ def get_all_characters_from_file():
     except (FileNotFoundError, json.JSONDecodeError):
         return [] # 파일이 없거나 비어있으면 빈 리스트 반환
 
+@traced("file.save_character")
 def save_character_to_file(character_data: dict):
     """새로운 캐릭터 하나를 파일에 추가합니다."""
     characters = get_all_characters_from_file()
     characters.append(character_data)
     with open(CHARACTER_FILE, "w", encoding="utf-8") as f:
         json.dump(characters, f, ensure_ascii=False, indent=2)
+    invalidate_character_pool()
     return character_data
 
+@traced("file.delete_character")
 def delete_character_from_file(character_id: str):
     """ID를 기준으로 캐릭터를 삭제하고, 연관된 이미지 파일도 삭제합니다."""
     characters = get_all_characters_from_file()
@@ -34,27 +88,17 @@ def delete_character_from_file(character_id: str):
     if not char_to_delete:
         return False
 
-    # --- 이미지 파일 삭제 로직 추가 ---
-    image_url = char_to_delete.get('image_url')
-    if image_url:
-        # URL 경로 (예: /static/images/...)를 실제 파일 시스템 경로 (예: static/images/...)로 변환합니다.
-        # lstrip('/')은 맨 앞의 '/'만 안전하게 제거합니다.
-        image_path = image_url.lstrip('/')
-        if os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                print(f"이미지 파일 삭제 성공: {image_path}")
-            except OSError as e:
-                print(f"이미지 파일 삭제 실패: {e}")
-        else:
-            print(f"삭제할 이미지 파일을 찾을 수 없음: {image_path}")
-    # --------------------------------
-
     # 캐릭터 데이터 리스트에서 해당 캐릭터를 제외합니다.
     updated_characters = [char for char in characters if char.get('id') != character_id]
     
     # 업데이트된 리스트를 다시 JSON 파일에 씁니다.
     with open(CHARACTER_FILE, "w", encoding="utf-8") as f:
         json.dump(updated_characters, f, ensure_ascii=False, indent=2)
+    invalidate_character_pool()
+
+    # --- 이미지 파일 삭제 로직 ---
+    # 캐릭터 목록을 먼저 저장한 뒤 정리합니다. 같은 이미지를 참조하는 다른 캐릭터가 남아 있으면 파일은 삭제하지 않습니다.
+    release_image(char_to_delete.get('image_url'), updated_characters)
+    # --------------------------------
         
     return True
@@ -1,13 +1,19 @@
 # gemini_service
 
 import os
+import re
 import uuid
 import json
+import orjson
+from pydantic import ValidationError
 from google import genai
 from dotenv import load_dotenv
 from google.genai import types
 from PIL import Image, ImageDraw
 from io import BytesIO
+from models import CharacterData, TypeChart, TypeMatchup
+from services.sprite_service import SPRITE_SIZE, save_sprite
+from services.tracing import span, traced
 
 
 # .env 파일에서 환경 변수를 로드합니다.
@@ -26,30 +32,54 @@ try:
 except Exception as e:
     print(f"Gemini API 클라이언트 초기화 실패: {e}")
     client = None
-    
 
-def get_llm_response(input_text: str):
+# 상성표 응답에서 빠지거나 잘못된 조합만 다시 요청하는 최대 횟수
+TYPE_CHART_MAX_RETRIES = 2
+# 캐릭터 응답이 스키마에 맞지 않을 때 다시 요청하는 최대 횟수
+CHARACTER_MAX_RETRIES = 1
+
+@traced("llm.generate_content")
+def get_llm_response(input_text: str, response_schema=None):
     """
     미리 생성된 API 클라이언트를 사용하여 Gemini API를 호출합니다.
+    response_schema(pydantic 모델)를 주면 해당 JSON 스키마에 맞춘 응답을 요청합니다.
     """
     # 클라이언트가 성공적으로 초기화되었는지 확인합니다.
     if client is None:
         print("API 클라이언트가 초기화되지 않아 요청을 처리할 수 없습니다.")
         return None
 
+    config = None
+    if response_schema is not None:
+        config = types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=response_schema
+        )
+
     try:
         # 요청마다 클라이언트를 새로 만드는 대신, 이미 만들어진 객체를 재사용합니다.
         response = client.models.generate_content(
             model="models/gemini-2.5-flash", 
-            contents=input_text
+            contents=input_text,
+            config=config
         )
-        
-        cleaned_text = response.text.strip().replace("```json", "").replace("```", "").strip()
-        return cleaned_text
+        return response.text
     except Exception as e:
         print(f"Gemini API 호출 중 오류 발생: {e}")
         return None
 
+def parse_llm_json(text: str):
+    """
+    LLM 응답 문자열을 orjson으로 파싱합니다.
+    스키마 없이 요청한 응답처럼 Markdown 코드 블록으로 감싸진 경우에만 이를 벗겨내고 다시 시도합니다.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        cleaned_text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+        return orjson.loads(cleaned_text)
+
+@traced()
 def create_character(user_description: str):
     """
     사용자 설명을 기반으로 캐릭터 생성 프롬프트를 만들고 LLM을 호출하는 메인 서비스 함수.
@@ -64,16 +94,24 @@ def create_character(user_description: str):
     # 최종적으로 LLM에 보낼 전체 프롬프트
     full_prompt = f"{system_prompt}\n\n### [사용자 입력]\n{user_description}"
 
-    # LLM 호출
-    llm_response_str = get_llm_response(full_prompt)
+    # LLM 호출 (CharacterData 스키마에 맞춘 JSON 응답)
+    character = None
+    for attempt in range(CHARACTER_MAX_RETRIES + 1):
+        llm_response_str = get_llm_response(full_prompt, response_schema=CharacterData)
+        if llm_response_str is None:
+            return None
 
-    if llm_response_str is None:
+        try:
+            character = CharacterData.model_validate(parse_llm_json(llm_response_str))
+            break
+        except (orjson.JSONDecodeError, ValidationError) as e:
+            print(f"캐릭터 JSON 검증 실패 (시도 {attempt + 1}/{CHARACTER_MAX_RETRIES + 1}): {e}")
+
+    if character is None:
         return None
 
-    # LLM이 반환한 문자열(JSON 형식)을 실제 Python 딕셔너리로 변환
     try:
-        character_data = json.loads(llm_response_str)
-
+        character_data = character.model_dump(by_alias=True)
         character_data['id'] = str(uuid.uuid4())
         
         # 캐릭터 설명이나 이름을 바탕으로 이미지 생성 프롬프트를 만듭니다.
@@ -88,9 +126,10 @@ def create_character(user_description: str):
 
         return character_data
     except Exception as e:
-        print(f"JSON 파싱 또는 이미지 생성 중 오류: {e}")
+        print(f"이미지 생성 중 오류: {e}")
         return None
 
+@traced("image.generate_character")
 def generate_character_image(base_prompt: str) -> str | None:
     """
     Gemini API를 사용하여 캐릭터 이미지를 생성하고,
@@ -103,26 +142,18 @@ def generate_character_image(base_prompt: str) -> str | None:
         full_prompt = f"A full body character portrait of a {base_prompt}, fantasy art style, detailed, vibrant colors, white background, no text in background, 1:1 aspect ratio, facing right"
 
         # Gemini 이미지 생성 모델 호출
-        response = client.models.generate_content(
-            model='gemini-2.0-flash-preview-image-generation',
-            contents=(full_prompt),
-            config=types.GenerateContentConfig(
-            response_modalities=['TEXT', 'IMAGE']
+        with span("llm.generate_image"):
+            response = client.models.generate_content(
+                model='gemini-2.0-flash-preview-image-generation',
+                contents=(full_prompt),
+                config=types.GenerateContentConfig(
+                response_modalities=['TEXT', 'IMAGE']
+                )
             )
-        )
 
         # 응답에서 이미지 데이터만 추출하여 저장
         for part in response.candidates[0].content.parts:
             if part.inline_data is not None:
-                # 1. 고유한 파일 이름 생성 (예: image_abc-123.png)
-                filename = f"image_{uuid.uuid4()}.png"
-                
-                # 2. 이미지를 저장할 폴더 경로 설정 (폴더가 없으면 생성)
-                save_dir = "static/images"
-                os.makedirs(save_dir, exist_ok=True)
-                save_path = os.path.join(save_dir, filename)
-
-                # 3. 이미지 데이터를 파일로 저장
                 original_image = Image.open(BytesIO(part.inline_data.data))
 
                 # --- 1. Flood Fill을 이용한 배경 제거 (가장 먼저 실행) ---
@@ -157,28 +188,19 @@ def generate_character_image(base_prompt: str) -> str | None:
                 squared_image.paste(img_bg_removed, paste_position, img_bg_removed)
                 # ----------------------------------------------------
 
-                # --- 3. 64x64 해상도로 작게 픽셀화 ---
-                small_pixelated_image = squared_image.resize((128, 128), Image.Resampling.NEAREST)
+                # --- 3. 128x128 해상도로 작게 픽셀화 ---
+                # 확대하지 않고 원본 픽셀아트 해상도로 저장합니다. (확대는 클라이언트에서 Nearest 필터로 처리)
+                pixelated_image = squared_image.resize((SPRITE_SIZE, SPRITE_SIZE), Image.Resampling.NEAREST)
                 # ----------------------------------------------------
 
-                # --- 4. 최종 결과물로 256x256 크기 확대 ---
-                # NEAREST 필터를 사용해야 픽셀 느낌이 깨지지 않고 선명하게 확대됩니다.
-                final_image = small_pixelated_image.resize((256, 256), Image.Resampling.NEAREST)
+                # --- 4. 팔레트 양자화 후 최적화된 PNG/WebP로 저장 ---
+                image_url = save_sprite(pixelated_image)
                 # ----------------------------------------------------
 
-                # 고유한 파일 이름 생성
-                filename = f"image_{uuid.uuid4()}.png"
-                save_dir = "static/images"
-                os.makedirs(save_dir, exist_ok=True)
-                save_path = os.path.join(save_dir, filename)
-
-                # 최종적으로 처리된 이미지를 저장합니다.
-                final_image.save(save_path)
-                
-                print(f"이미지 처리 및 저장 완료: {save_path}")
+                print(f"이미지 처리 및 저장 완료: {image_url}")
                 
                 # 웹에서 접근 가능한 URL 경로를 반환합니다.
-                return f"/{save_path}"
+                return image_url
 
         # 루프가 끝날 때까지 이미지를 찾지 못했다면
         print("API 응답에서 이미지를 찾지 못했습니다.")
@@ -188,39 +210,105 @@ def generate_character_image(base_prompt: str) -> str | None:
         print(f"Gemini 이미지 생성/저장 중 오류 발생: {e}")
         return None
 
-def calculate_type_chart(player_skill_types, enemy_character_types, enemy_skill_types, player_character_types):
+@traced()
+def calculate_type_chart(player_skill_types, enemy_character_types, enemy_skill_types, player_character_types, known_chart: dict = None):
     """
     모든 고유 타입 조합에 대한 상성표를 LLM을 통해 계산합니다.
+    응답은 항목별로 검증하고, 빠지거나 잘못된 조합만 골라 다시 요청합니다.
+    known_chart(이전에 받아 둔 미완성 상성표)를 주면 그 안의 조합은 다시 요청하지 않습니다.
+
+    재시도 후에도 받지 못한 조합이 있으면 받은 항목만 담고 "incomplete": True를 붙여 반환합니다.
+    이 경우 값을 임의로 채우지 않으므로, 호출한 쪽은 상성표를 저장하지 말고 나중에 다시 요청해야 합니다.
     """
     # 백엔드에서 모든 조합을 미리 만들어 플랫 리스트 형태로 LLM에게 전달합니다.
-    player_vs_enemy_pairs = [{"attacker": p_skill, "defender": e_char} for p_skill in player_skill_types for e_char in enemy_character_types]
-    enemy_vs_player_pairs = [{"attacker": e_skill, "defender": p_char} for e_skill in enemy_skill_types for p_char in player_character_types]
-
-    # LLM에게 전달할 최종 입력 데이터 구조
-    input_data = {
-        "player_vs_enemy_to_calculate": player_vs_enemy_pairs,
-        "enemy_vs_player_to_calculate": enemy_vs_player_pairs
+    requested = {
+        "player_vs_enemy": [(p_skill, e_char) for p_skill in player_skill_types for e_char in enemy_character_types],
+        "enemy_vs_player": [(e_skill, p_char) for e_skill in enemy_skill_types for p_char in player_character_types],
     }
+    # { "player_vs_enemy": { (attacker, defender): multiplier }, ... }
+    results = {section: {} for section in requested}
+    for section, pairs in requested.items():
+        wanted = set(pairs)
+        for entry in (known_chart or {}).get(section, []):
+            pair = (entry["attacker"], entry["defender"])
+            if pair in wanted:
+                results[section][pair] = entry["multiplier"]
 
     # 시스템 프롬프트
     with open('skill_prompt.txt', 'r', encoding='utf-8') as f:
         system_prompt = f.read()
-    
-    
-    full_prompt = f"{system_prompt}\n\n### [입력 데이터]\n{json.dumps(input_data, ensure_ascii=False, indent=2)}"
 
-    llm_response_str = get_llm_response(full_prompt)
-    if llm_response_str is None:
+    for attempt in range(TYPE_CHART_MAX_RETRIES + 1):
+        missing = {section: [pair for pair in pairs if pair not in results[section]] for section, pairs in requested.items()}
+        missing_count = sum(len(pairs) for pairs in missing.values())
+        if missing_count == 0:
+            break
+        if attempt > 0:
+            print(f"상성표 누락/오류 조합 {missing_count}개 재요청 (재시도 {attempt}/{TYPE_CHART_MAX_RETRIES})")
+
+        # LLM에게 전달할 최종 입력 데이터 구조
+        input_data = {
+            "player_vs_enemy_to_calculate": [{"attacker": a, "defender": d} for a, d in missing["player_vs_enemy"]],
+            "enemy_vs_player_to_calculate": [{"attacker": a, "defender": d} for a, d in missing["enemy_vs_player"]]
+        }
+        full_prompt = f"{system_prompt}\n\n### [입력 데이터]\n{json.dumps(input_data, ensure_ascii=False, indent=2)}"
+
+        llm_response_str = get_llm_response(full_prompt, response_schema=TypeChart)
+        if llm_response_str is None:
+            continue
+
+        for section, entries in _extract_type_chart_entries(llm_response_str).items():
+            wanted = set(missing[section])
+            for entry in entries:
+                try:
+                    matchup = TypeMatchup.model_validate(entry)
+                except ValidationError:
+                    continue
+                pair = (matchup.attacker, matchup.defender)
+                if pair in wanted:
+                    results[section][pair] = matchup.multiplier
+
+    if not any(results.values()):
+        print("상성표 계산 실패: 유효한 조합을 하나도 받지 못했습니다.")
         return None
 
+    type_chart = {}
+    for section, pairs in requested.items():
+        unresolved = [pair for pair in pairs if pair not in results[section]]
+        if unresolved:
+            print(f"상성표 {section} 조합 {len(unresolved)}개를 끝내 받지 못했습니다: {unresolved}")
+            type_chart["incomplete"] = True
+        type_chart[section] = [
+            {"attacker": a, "defender": d, "multiplier": results[section][(a, d)]}
+            for a, d in pairs if (a, d) in results[section]
+        ]
+    return type_chart
+
+_JSON_OBJECT_PATTERN = re.compile(r"\{[^{}]*\}")
+
+def _extract_type_chart_entries(text: str) -> dict:
+    """
+    상성표 응답에서 섹션별 항목 리스트를 꺼냅니다.
+    응답이 잘려 전체 JSON 파싱에 실패하면, 완전한 형태로 남아 있는 항목만이라도 건져냅니다.
+    """
     try:
-        # --- (수정된 부분) ---
-        # LLM이 반환한 JSON 호환 딕셔너리를 그대로 반환합니다.
-        # 튜플을 키로 사용하는 딕셔너리로 변환하지 않습니다.
-        type_chart = json.loads(llm_response_str)
-        return type_chart
-        # --------------------
-
-    except json.JSONDecodeError as e:
-        print(f"상성표 JSON 파싱 오류: {e}")
-        return None
+        parsed = parse_llm_json(text)
+        if isinstance(parsed, dict):
+            return {
+                section: parsed.get(section) if isinstance(parsed.get(section), list) else []
+                for section in ("player_vs_enemy", "enemy_vs_player")
+            }
+        return {}
+    except orjson.JSONDecodeError as e:
+        print(f"상성표 JSON 파싱 오류, 남은 항목만 복구합니다: {e}")
+
+    entries = {"player_vs_enemy": [], "enemy_vs_player": []}
+    boundary = text.find('"enemy_vs_player"')
+    for match in _JSON_OBJECT_PATTERN.finditer(text):
+        try:
+            entry = orjson.loads(match.group())
+        except orjson.JSONDecodeError:
+            continue
+        section = "enemy_vs_player" if 0 <= boundary < match.start() else "player_vs_enemy"
+        entries[section].append(entry)
+    return entries
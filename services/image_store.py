@@ -0,0 +1,173 @@
+# image_store
+
+import hashlib
+import os
+import uuid
+from io import BytesIO
+
+from PIL import Image
+
+from services.tracing import traced
+
+# 내용 해시(sha256)를 파일 이름으로 쓰는 이미지 저장소. 같은 내용의 스프라이트는 한 번만 저장됩니다.
+# /static 마운트 밖에 두어, 캐시 헤더가 붙는 /images 경로로만 제공되도록 합니다.
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "data/images")
+IMAGE_URL_PREFIX = "/images/"
+# 파일 이름이 내용 해시이므로 내용이 바뀌면 URL도 바뀝니다. 따라서 영구 캐시해도 안전합니다.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+
+def _blob_path(digest: str, ext: str) -> str:
+    return os.path.join(IMAGE_STORE_DIR, f"{digest}.{ext}")
+
+
+def _variant_path(digest: str) -> str:
+    # PNG 원본에 대해 미리 만들어 둔 무손실 WebP 변형
+    return os.path.join(IMAGE_STORE_DIR, f"{digest}.variant.webp")
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+@traced("file.store_image")
+def store_image_bytes(data: bytes, ext: str) -> str:
+    """
+    이미지 바이트를 내용 해시 이름으로 저장하고 웹 경로(/images/<sha256>.<ext>)를 반환합니다.
+    이미 같은 내용이 저장되어 있으면 파일을 다시 쓰지 않습니다.
+    """
+    if ext not in MEDIA_TYPES:
+        raise ValueError(f"지원하지 않는 이미지 형식입니다: {ext}")
+    digest = hashlib.sha256(data).hexdigest()
+    path = _blob_path(digest, ext)
+    if not os.path.exists(path):
+        os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+        _write_atomic(path, data)
+        if ext == "png":
+            _write_webp_variant(digest, data)
+    return f"{IMAGE_URL_PREFIX}{digest}.{ext}"
+
+
+def _write_webp_variant(digest: str, png_data: bytes):
+    """PNG보다 작을 때만 무손실 WebP 변형을 함께 저장합니다. (image/webp를 받는 클라이언트용)"""
+    try:
+        buffer = BytesIO()
+        with Image.open(BytesIO(png_data)) as image:
+            image.convert("RGBA").save(buffer, format="WEBP", lossless=True, quality=100, method=6)
+        if buffer.tell() < len(png_data):
+            _write_atomic(_variant_path(digest), buffer.getvalue())
+    except OSError as e:
+        print(f"WebP 변형 생성 실패: {digest} ({e})")
+
+
+def parse_image_url(image_url: str):
+    """저장소 URL이면 (digest, ext)를, 아니면 None을 반환합니다."""
+    if not image_url or not image_url.startswith(IMAGE_URL_PREFIX):
+        return None
+    name = image_url[len(IMAGE_URL_PREFIX):]
+    digest, _, ext = name.partition(".")
+    if len(digest) != 64 or ext not in MEDIA_TYPES or any(c not in "0123456789abcdef" for c in digest):
+        return None
+    return digest, ext
+
+
+def resolve_image_path(image_url: str) -> str:
+    """
+    image_url을 실제 파일 경로로 바꿉니다.
+    저장소 URL(/images/...)과 기존 정적 파일 URL(/static/images/...)을 모두 처리합니다.
+    """
+    parsed = parse_image_url(image_url)
+    if parsed:
+        return _blob_path(*parsed)
+    # URL 경로 (예: /static/images/...)를 실제 파일 시스템 경로 (예: static/images/...)로 변환합니다.
+    return image_url.lstrip('/')
+
+
+def migrate_legacy_image(image_url: str) -> str | None:
+    """
+    기존 정적 파일 URL(/static/images/image_<uuid>.png)의 이미지를 내용 해시 이름으로 저장소에 옮기고 새 URL을 반환합니다.
+    이미 저장소 URL이거나 원본 파일이 없으면 None을 반환합니다. 원본 파일은 지우지 않습니다.
+    """
+    if not image_url or parse_image_url(image_url):
+        return None
+    ext = os.path.splitext(image_url)[1].lstrip(".").lower()
+    if ext not in MEDIA_TYPES:
+        return None
+    try:
+        with open(resolve_image_path(image_url), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        print(f"옮길 이미지 파일을 찾을 수 없음: {image_url}")
+        return None
+    return store_image_bytes(data, ext)
+
+
+def find_image(image_url: str, accept: str = "") -> tuple | None:
+    """
+    저장소 이미지를 찾아 (파일 경로, media type, ETag)를 반환합니다.
+    클라이언트가 image/webp를 받고 WebP 변형이 있으면 변형을 반환합니다.
+    """
+    parsed = parse_image_url(image_url)
+    if parsed is None:
+        return None
+    digest, ext = parsed
+    path = _blob_path(digest, ext)
+    if not os.path.exists(path):
+        return None
+
+    if ext == "png" and "image/webp" in accept:
+        variant_path = _variant_path(digest)
+        if os.path.exists(variant_path):
+            return variant_path, MEDIA_TYPES["webp"], f'"{digest}-webp"'
+    return path, MEDIA_TYPES[ext], f'"{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match 헤더가 etag와 일치하는지 확인합니다. (여러 값, '*', 약한 비교 W/ 지원)"""
+    if not if_none_match:
+        return False
+    candidates = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def count_image_references(characters: list, image_url: str) -> int:
+    """캐릭터 목록에서 image_url을 참조하는 캐릭터 수를 셉니다."""
+    return sum(1 for char in characters if char.get('image_url') == image_url)
+
+
+@traced("file.release_image")
+def release_image(image_url: str, remaining_characters: list) -> bool:
+    """
+    남은 캐릭터 중 image_url을 참조하는 캐릭터가 없을 때만 이미지 파일(및 변형)을 삭제합니다.
+    같은 스프라이트를 공유하는 다른 캐릭터가 있으면 파일을 유지합니다.
+    """
+    if not image_url:
+        return False
+    references = count_image_references(remaining_characters, image_url)
+    if references > 0:
+        print(f"이미지 파일 유지 (다른 캐릭터 {references}명이 참조 중): {image_url}")
+        return False
+
+    paths = [resolve_image_path(image_url)]
+    parsed = parse_image_url(image_url)
+    if parsed and parsed[1] == "png":
+        paths.append(_variant_path(parsed[0]))
+
+    deleted = False
+    for image_path in paths:
+        if not os.path.exists(image_path):
+            continue
+        try:
+            os.remove(image_path)
+            deleted = True
+            print(f"이미지 파일 삭제 성공: {image_path}")
+        except OSError as e:
+            print(f"이미지 파일 삭제 실패: {e}")
+    if not deleted:
+        print(f"삭제할 이미지 파일을 찾을 수 없음: {paths[0]}")
+    return deleted
@@ -0,0 +1,334 @@
+# run_journal
+
+import hashlib
+import os
+import threading
+import time
+
+import orjson
+
+RUN_JOURNAL_DIR = os.getenv("RUN_JOURNAL_DIR", "data/runs")
+# 이 개수만큼 이벤트가 쌓이면 스냅샷으로 압축하고 저널을 비웁니다.
+RUN_JOURNAL_SNAPSHOT_EVERY = int(os.getenv("RUN_JOURNAL_SNAPSHOT_EVERY", "500"))
+# 이 시간(초) 동안 활동이 없는 Run은 버려진 것으로 보고 정리합니다.
+RUN_IDLE_TTL_SECONDS = int(os.getenv("RUN_IDLE_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+class RunJournal:
+    """
+    runs_db의 변경 사항을 추가 전용(append-only) 저널 파일에 기록하고,
+    서버 재시작 시 스냅샷 + 저널을 재생하여 진행 중인 Run을 복구합니다.
+
+    기록하는 이벤트는 모두 멱등(idempotent)이므로, 스냅샷 직후에 같은 이벤트가
+    저널에 한 번 더 남아 있어도 복구 결과는 같습니다.
+    - create:   Run 생성 (플레이어 캐릭터, 적 목록)
+    - start:    층 상성표 계산 시작
+    - chart:    층 상성표 계산 완료
+    - complete: Run 종료
+    - expire:   오래 활동이 없어 정리된 Run
+
+    압축은 저널 파일을 journal.old.jsonl로 넘긴 뒤 별도 스레드에서 스냅샷을 쓰므로,
+    기록(record_*)하는 쪽은 스냅샷 작성을 기다리지 않습니다.
+    """
+
+    def __init__(self, directory: str = RUN_JOURNAL_DIR, snapshot_every: int = RUN_JOURNAL_SNAPSHOT_EVERY, idle_ttl: int = RUN_IDLE_TTL_SECONDS):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.idle_ttl = idle_ttl
+        self.journal_path = os.path.join(directory, "journal.jsonl")
+        self.old_journal_path = os.path.join(directory, "journal.old.jsonl")
+        self.snapshot_path = os.path.join(directory, "snapshot.jsonl")
+        self._lock = threading.Lock()
+        self._events_since_snapshot = 0
+        self._runs = {}
+        self._pending = {}
+        self._file = None
+        self._compaction = None
+
+    # --- 복구 ---
+
+    def load(self) -> dict:
+        """
+        스냅샷 → 압축 중이던 저널(있으면) → 현재 저널 순서로 재생하여 runs_db를 재구성합니다.
+        반환된 딕셔너리는 이후 스냅샷 작성 시 그대로 사용되므로, 호출한 쪽에서 runs_db로 써야 합니다.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        runs = {}
+        pending = {}  # { run_id: {계산이 시작됐지만 끝나지 않은 층 번호} }
+        _load_snapshot(_read_records(self.snapshot_path), runs, pending)
+
+        journal_records = _read_records(self.old_journal_path) + _read_records(self.journal_path)
+        for event in journal_records:
+            _apply_event(runs, pending, event)
+
+        # 재시작 전에 이미 방치되어 있던 Run은 복구하지 않습니다.
+        expired = [run_id for run_id, run_session in runs.items() if self._is_idle(run_session, time.time())]
+        for run_id in expired:
+            runs.pop(run_id)
+
+        self._runs = runs
+        self._pending = {run_id: floors for run_id, floors in pending.items() if run_id in runs and floors}
+        self._events_since_snapshot = len(journal_records)
+        _truncate_torn_tail(self.journal_path)
+        self._file = open(self.journal_path, "ab")
+        for run_id in expired:
+            self.record_run_expired(run_id)
+        print(f"Run 저널 복구 완료: {len(runs)}개 Run, 재계산 대기 {sum(len(f) for f in self._pending.values())}개 층, 만료 {len(expired)}개 Run")
+        return runs
+
+    def pending_floors(self) -> list:
+        """복구 시점에 계산 중이던 (run_id, floor_number) 목록을 반환합니다. 재시작 후 다시 큐에 넣어야 합니다."""
+        return [(run_id, floor) for run_id, floors in self._pending.items() for floor in sorted(floors)]
+
+    def close(self):
+        """진행 중인 압축이 끝나기를 기다린 뒤 저널 파일을 닫습니다."""
+        with self._lock:
+            compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # --- 기록 ---
+
+    def record_run_created(self, run_id: str, player_characters: list, enemies: list):
+        self._append({"op": "create", "run_id": run_id, "player_characters": player_characters, "enemies": enemies})
+
+    def record_floor_started(self, run_id: str, floor_number: int):
+        self._append({"op": "start", "run_id": run_id, "floor": floor_number})
+
+    def record_floor_chart(self, run_id: str, floor_number: int, type_chart: dict):
+        self._append({"op": "chart", "run_id": run_id, "floor": floor_number, "chart": type_chart})
+
+    def record_run_completed(self, run_id: str):
+        self._append({"op": "complete", "run_id": run_id})
+
+    def record_run_expired(self, run_id: str):
+        self._append({"op": "expire", "run_id": run_id})
+
+    def _append(self, event: dict):
+        # 이벤트 시각은 재시작 후 Run의 마지막 활동 시각을 복구하는 데 사용합니다.
+        event["ts"] = time.time()
+        line = orjson.dumps(event) + b"\n"
+        with self._lock:
+            if self._file is None:
+                # load()가 호출되지 않았다면 기록하지 않습니다.
+                return
+            try:
+                self._file.write(line)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as e:
+                print(f"Run 저널 기록 실패: {e}")
+                return
+
+            self._events_since_snapshot += 1
+            if self._events_since_snapshot >= self.snapshot_every and (self._compaction is None or not self._compaction.is_alive()):
+                self._start_compaction()
+
+    # --- 방치된 Run 정리 ---
+
+    def touch(self, run_session: dict):
+        """Run의 마지막 활동 시각을 갱신합니다."""
+        run_session["last_active"] = time.time()
+
+    def evict_idle_runs(self) -> list:
+        """idle_ttl보다 오래 활동이 없는 Run을 runs_db에서 제거하고 expire 이벤트로 기록합니다."""
+        now = time.time()
+        expired = [run_id for run_id, run_session in list(self._runs.items()) if self._is_idle(run_session, now)]
+        for run_id in expired:
+            if self._runs.pop(run_id, None) is not None:
+                self._pending.pop(run_id, None)
+                self.record_run_expired(run_id)
+        if expired:
+            print(f"활동이 없는 Run {len(expired)}개를 정리했습니다.")
+        return expired
+
+    def _is_idle(self, run_session: dict, now: float) -> bool:
+        return now - run_session.get("last_active", now) > self.idle_ttl
+
+    # --- 스냅샷 ---
+
+    def _start_compaction(self):
+        """
+        (self._lock을 잡은 상태에서 호출) 현재 상태를 복사하고 저널을 넘긴 뒤, 스냅샷은 별도 스레드에서 씁니다.
+        복사본에는 넘긴 저널의 이벤트가 모두 반영되어 있으므로, 스냅샷이 완성되면 넘긴 저널은 지워도 됩니다.
+        """
+        state = _capture_state(self._runs)
+        try:
+            self._file.close()
+            if os.path.exists(self.old_journal_path):
+                # 이전 압축이 실패해 남아 있는 저널 뒤에 현재 저널을 이어 붙입니다.
+                with open(self.journal_path, "rb") as src, open(self.old_journal_path, "ab") as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                open(self.journal_path, "wb").close()
+            else:
+                os.replace(self.journal_path, self.old_journal_path)
+        except OSError as e:
+            print(f"Run 저널 압축 준비 실패: {e}")
+            return
+        finally:
+            self._file = open(self.journal_path, "ab")
+
+        self._events_since_snapshot = 0
+        self._compaction = threading.Thread(target=self._write_snapshot, args=(state,), daemon=True)
+        self._compaction.start()
+
+    def _write_snapshot(self, state: list):
+        lines = _snapshot_lines(state)
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.old_journal_path)
+            print(f"Run 저널 스냅샷 저장 완료: {len(state)}개 Run")
+        except OSError as e:
+            # 넘긴 저널이 남아 있으므로 복구에는 지장이 없습니다. 다음 압축 때 다시 시도합니다.
+            print(f"Run 저널 스냅샷 저장 실패: {e}")
+
+
+def _capture_state(runs: dict) -> list:
+    """스냅샷에 필요한 값만 얕게 복사합니다. 적/플레이어 목록은 생성 후 바뀌지 않으므로 참조만 복사합니다."""
+    state = []
+    for run_id, run_session in list(runs.items()):
+        data = run_session["data"]
+        charts = dict(data["type_charts"])
+        pending = [floor for floor in list(data["calculation_triggered"]) if str(floor) not in charts]
+        state.append((run_id, data["player_characters"], data["enemies"], charts, pending, run_session.get("last_active")))
+    return state
+
+
+def _snapshot_lines(state: list) -> list:
+    """
+    스냅샷 줄 목록을 만듭니다. 캐릭터는 내용 해시를 키로 한 번만 "character" 레코드로 쓰고,
+    Run 레코드에는 키 목록만 남깁니다. (같은 풀에서 뽑힌 적이 Run마다 반복 저장되지 않도록)
+    """
+    keys_by_object = {}  # 같은 딕셔너리 객체는 한 번만 직렬화합니다.
+    written = set()
+    character_lines = []
+    run_lines = []
+
+    def character_key(character: dict) -> str:
+        key = keys_by_object.get(id(character))
+        if key is None:
+            blob = orjson.dumps(character)
+            key = hashlib.sha256(blob).hexdigest()[:16]
+            keys_by_object[id(character)] = key
+            if key not in written:
+                written.add(key)
+                character_lines.append(b'{"type":"character","key":"' + key.encode() + b'","data":' + blob + b"}\n")
+        return key
+
+    for run_id, player_characters, enemies, charts, pending, last_active in state:
+        run_lines.append(orjson.dumps({
+            "type": "run",
+            "run_id": run_id,
+            "player_characters": [character_key(char) for char in player_characters],
+            "enemies": [character_key(enemy) for enemy in enemies],
+            "type_charts": charts,
+            "pending": pending,
+            "last_active": last_active,
+        }) + b"\n")
+    # 복구 시 캐릭터 표를 먼저 읽을 수 있도록 캐릭터 레코드를 앞에 둡니다.
+    return character_lines + run_lines
+
+
+def _load_snapshot(records: list, runs: dict, pending: dict):
+    characters = {}
+    for record in records:
+        if record.get("type") == "character":
+            characters[record["key"]] = record["data"]
+        elif record.get("type") == "run":
+            run_id = record["run_id"]
+            runs[run_id] = _restore_run_data({
+                "player_characters": [characters[key] for key in record["player_characters"]],
+                "enemies": [characters[key] for key in record["enemies"]],
+                "type_charts": record.get("type_charts", {}),
+            }, record.get("last_active"))
+            if record.get("pending"):
+                pending[run_id] = set(record["pending"])
+
+
+def _read_records(path: str) -> list:
+    """JSONL 파일을 읽어 레코드 리스트로 반환합니다. 비정상 종료로 잘린 마지막 줄은 건너뜁니다."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return []
+
+    records = []
+    for line in raw.splitlines():
+        if not line:
+            continue
+        try:
+            records.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            print(f"Run 저널의 손상된 줄을 건너뜁니다: {path}")
+    return records
+
+
+def _truncate_torn_tail(path: str):
+    """
+    비정상 종료로 마지막 줄이 잘려 있으면 마지막 줄바꿈 위치까지 파일을 잘라냅니다.
+    그대로 "ab"로 열면 다음 이벤트가 잘린 줄 뒤에 붙어 함께 손상되기 때문입니다.
+    """
+    try:
+        with open(path, "r+b") as f:
+            raw = f.read()
+            if not raw or raw.endswith(b"\n"):
+                return
+            f.truncate(raw.rfind(b"\n") + 1)
+            print(f"Run 저널의 잘린 마지막 줄을 제거했습니다: {path}")
+    except FileNotFoundError:
+        return
+
+
+def _restore_run_data(data: dict, last_active: float = None) -> dict:
+    """저장된 Run 데이터를 runs_db 형식으로 되돌립니다. 완료된 층만 calculation_triggered에 표시합니다."""
+    type_charts = data.get("type_charts", {})
+    return {
+        "data": {
+            "player_characters": data["player_characters"],
+            "enemies": data["enemies"],
+            "type_charts": type_charts,
+            "calculation_triggered": {int(floor): True for floor in type_charts},
+        },
+        "last_active": last_active or time.time(),
+    }
+
+
+def _apply_event(runs: dict, pending: dict, event: dict):
+    run_id = event.get("run_id")
+    op = event.get("op")
+
+    if op == "create":
+        if run_id not in runs:
+            runs[run_id] = _restore_run_data(event, event.get("ts"))
+            pending[run_id] = set()
+    elif op in ("complete", "expire"):
+        runs.pop(run_id, None)
+        pending.pop(run_id, None)
+    elif run_id not in runs:
+        # 이미 종료된 Run에 대한 늦은 이벤트는 무시합니다.
+        return
+    elif op == "start":
+        if str(event["floor"]) not in runs[run_id]["data"]["type_charts"]:
+            pending.setdefault(run_id, set()).add(event["floor"])
+    elif op == "chart":
+        floor = event["floor"]
+        data = runs[run_id]["data"]
+        data["type_charts"][str(floor)] = event["chart"]
+        data["calculation_triggered"][floor] = True
+        pending.get(run_id, set()).discard(floor)
+
+    if run_id in runs and event.get("ts"):
+        runs[run_id]["last_active"] = max(runs[run_id]["last_active"], event["ts"])
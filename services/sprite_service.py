@@ -0,0 +1,188 @@
+# sprite_service
+
+import glob
+import hashlib
+import math
+import os
+import re
+import uuid
+from io import BytesIO
+
+import orjson
+from PIL import Image
+
+from services.image_store import MEDIA_TYPES, resolve_image_path, store_image_bytes
+from services.tracing import traced
+
+# 픽셀아트 원본 해상도. 확대는 클라이언트에서 Point(Nearest) 필터로 처리합니다.
+SPRITE_SIZE = 128
+# 스프라이트 팔레트 색상 수 (PNG 팔레트 모드는 최대 256색)
+SPRITE_COLORS = int(os.getenv("SPRITE_COLORS", "256"))
+# "png": 팔레트 PNG, "webp": 무손실 WebP
+SPRITE_FORMAT = os.getenv("SPRITE_FORMAT", "png")
+
+# 아틀라스는 /static 마운트 밖에 두고 /atlases 경로로만 캐시 헤더와 함께 제공합니다.
+ATLAS_DIR = os.getenv("ATLAS_DIR", "data/atlases")
+ATLAS_URL_PREFIX = "/atlases/"
+_ATLAS_FILENAME = re.compile(r"atlas_([0-9a-f]{32})\.(png|webp)")
+# 디스크에 남겨 둘 아틀라스 수. 넘으면 가장 오래 쓰이지 않은 것부터 지웁니다. (LRU)
+ATLAS_CACHE_MAX_ENTRIES = int(os.getenv("ATLAS_CACHE_MAX_ENTRIES", "100"))
+# 아틀라스 안 스프라이트 사이의 투명 여백 (텍스처 필터링 시 번짐 방지)
+ATLAS_PADDING = 2
+
+
+def quantize_sprite(image: Image.Image, colors: int = SPRITE_COLORS) -> Image.Image:
+    """RGBA 이미지를 투명도를 유지한 팔레트(P) 이미지로 줄입니다."""
+    return image.convert("RGBA").quantize(colors=colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+
+def encode_image(image: Image.Image, fp, image_format: str):
+    """최적화된 PNG 또는 무손실 WebP로 저장합니다. fp는 파일 경로나 파일 객체입니다."""
+    if image_format == "webp":
+        image.convert("RGBA").save(fp, format="WEBP", lossless=True, quality=100, method=6)
+    else:
+        image.save(fp, format="PNG", optimize=True)
+
+
+@traced("image.save_sprite")
+def save_sprite(image: Image.Image) -> str:
+    """
+    스프라이트를 팔레트 양자화하여 원본 해상도 그대로 이미지 저장소에 저장하고, 웹 경로를 반환합니다.
+    """
+    buffer = BytesIO()
+    encode_image(quantize_sprite(image), buffer, SPRITE_FORMAT)
+    return store_image_bytes(buffer.getvalue(), SPRITE_FORMAT)
+
+
+# --- Run 단위 스프라이트 아틀라스 ---
+
+def _atlas_key(enemies: list) -> str:
+    """적 ID와 이미지 경로 조합으로 아틀라스 캐시 키를 만듭니다. 이미지가 바뀌면 키도 바뀝니다."""
+    entries = sorted(f"{enemy.get('id')}:{enemy.get('image_url')}" for enemy in enemies)
+    return hashlib.sha256("\n".join(entries).encode("utf-8")).hexdigest()[:32]
+
+
+def _load_sprite(image_url: str):
+    image_path = resolve_image_path(image_url)
+    try:
+        with Image.open(image_path) as image:
+            return image.convert("RGBA")
+    except (FileNotFoundError, OSError) as e:
+        print(f"아틀라스용 스프라이트를 불러오지 못했습니다: {image_path} ({e})")
+        return None
+
+
+def _pack(sizes: list) -> tuple:
+    """
+    (w, h) 목록을 높이순 선반(shelf) 방식으로 배치합니다.
+    반환값: (아틀라스 너비, 아틀라스 높이, 각 스프라이트의 (x, y) 목록)
+    """
+    # 같은 크기 스프라이트라면 정사각형에 가까운 격자가 되도록 한 줄 너비를 정합니다.
+    max_width = max(w for w, _ in sizes) + ATLAS_PADDING
+    atlas_width = math.ceil(math.sqrt(len(sizes))) * max_width
+
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[index]
+        if x + w + ATLAS_PADDING > atlas_width:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        positions[index] = (x, y)
+        x += w + ATLAS_PADDING
+        shelf_height = max(shelf_height, h + ATLAS_PADDING)
+
+    used_width = max(px + w for (px, _), (w, _) in zip(positions, sizes))
+    return used_width, y + shelf_height - ATLAS_PADDING, positions
+
+
+@traced("image.build_atlas")
+def get_run_atlas(enemies: list) -> dict | None:
+    """
+    Run의 적 스프라이트를 하나의 아틀라스 이미지로 묶고, 좌표 매니페스트를 반환합니다.
+    같은 적 조합이면 디스크에 캐시된 아틀라스를 그대로 재사용합니다.
+    """
+    key = _atlas_key(enemies)
+    manifest_path = os.path.join(ATLAS_DIR, f"atlas_{key}.json")
+
+    try:
+        with open(manifest_path, "rb") as f:
+            manifest = orjson.loads(f.read())
+        # 최근 사용 시각을 갱신하여 LRU 정리 대상에서 뒤로 미룹니다.
+        os.utime(manifest_path)
+        return manifest
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        pass
+
+    sprites = []
+    for index, enemy in enumerate(enemies):
+        if not enemy.get('image_url'):
+            continue
+        image = _load_sprite(enemy['image_url'])
+        if image is not None:
+            # ID가 없는 캐릭터는 Run 적 목록에서의 순서(문자열)를 키로 씁니다.
+            sprites.append((enemy.get('id') or str(index), image))
+    if not sprites:
+        return None
+
+    width, height, positions = _pack([image.size for _, image in sprites])
+    atlas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    frames = {}
+    for (enemy_id, image), (x, y) in zip(sprites, positions):
+        atlas.paste(image, (x, y))
+        frames[enemy_id] = {"x": x, "y": y, "w": image.width, "h": image.height}
+
+    # 아틀라스는 다시 양자화하지 않고 RGBA 그대로 저장합니다. (각 스프라이트와 픽셀이 정확히 같아야 합니다)
+    # 아틀라스는 Run마다 새로 생기는 캐시이므로 캐릭터 참조 수로 관리하는 이미지 저장소에 넣지 않고 ATLAS_DIR에 둡니다.
+    os.makedirs(ATLAS_DIR, exist_ok=True)
+    atlas_path = os.path.join(ATLAS_DIR, f"atlas_{key}.{SPRITE_FORMAT}")
+    tmp_atlas_path = f"{atlas_path}.{uuid.uuid4()}.tmp"
+    encode_image(atlas, tmp_atlas_path, SPRITE_FORMAT)
+    os.replace(tmp_atlas_path, atlas_path)
+
+    manifest = {"atlas_url": f"{ATLAS_URL_PREFIX}atlas_{key}.{SPRITE_FORMAT}", "width": width, "height": height, "frames": frames}
+    # 매니페스트를 마지막에 임시 파일 → rename으로 써서, 매니페스트가 있으면 아틀라스도 완성되어 있도록 합니다.
+    tmp_path = f"{manifest_path}.{uuid.uuid4()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(manifest))
+    os.replace(tmp_path, manifest_path)
+
+    _evict_atlases()
+    return manifest
+
+
+def find_atlas(filename: str) -> tuple | None:
+    """
+    아틀라스 파일을 찾아 (파일 경로, media type, ETag)를 반환합니다.
+    파일 이름의 키가 적 ID와 (내용 해시) 이미지 경로에서 나오므로, 같은 이름이면 내용도 같습니다.
+    """
+    match = _ATLAS_FILENAME.fullmatch(filename)
+    if match is None:
+        return None
+    path = os.path.join(ATLAS_DIR, filename)
+    if not os.path.exists(path):
+        return None
+    return path, MEDIA_TYPES[match.group(2)], f'"{match.group(1)}"'
+
+
+def _evict_atlases():
+    """ATLAS_CACHE_MAX_ENTRIES를 넘는 아틀라스를 마지막 사용 시각이 오래된 순서로 삭제합니다."""
+    manifests = []
+    for manifest_path in glob.glob(os.path.join(ATLAS_DIR, "atlas_*.json")):
+        try:
+            manifests.append((os.path.getmtime(manifest_path), manifest_path))
+        except FileNotFoundError:
+            continue
+    if len(manifests) <= ATLAS_CACHE_MAX_ENTRIES:
+        return
+
+    manifests.sort()
+    for _, manifest_path in manifests[:len(manifests) - ATLAS_CACHE_MAX_ENTRIES]:
+        # 매니페스트를 먼저 지워, 남은 매니페스트가 지워진 아틀라스를 가리키지 않도록 합니다.
+        prefix = manifest_path[:-len(".json")]
+        for path in [manifest_path] + glob.glob(f"{prefix}.png") + glob.glob(f"{prefix}.webp"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
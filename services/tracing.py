@@ -0,0 +1,307 @@
+# tracing
+
+import collections
+import contextvars
+import cProfile
+import functools
+import io
+import logging
+import os
+import queue
+import pstats
+import secrets
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import orjson
+
+# "off": 기록 안 함(기본값), "json": 스팬 하나당 한 줄의 간단한 JSON, "otlp": OTLP/JSON(File Exporter) 형식
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "off")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# app.log와 같은 방식으로 크기 기준 로테이션합니다.
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_FILE_BACKUP_COUNT = int(os.getenv("TRACE_FILE_BACKUP_COUNT", "5"))
+SERVICE_NAME = "airouge-backend"
+
+# 현재 실행 중인 스팬. 백그라운드 작업에도 그대로 전달됩니다.
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _create_trace_logger():
+    """
+    스팬을 큐에 넣기만 하고, 파일 쓰기는 별도 리스너 스레드가 RotatingFileHandler로 처리합니다.
+    미들웨어 스팬이 이벤트 루프에서 끝나더라도 파일 I/O가 루프를 막지 않습니다.
+    """
+    trace_logger = logging.getLogger("airouge.tracing")
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+    if TRACE_EXPORT == "off":
+        return trace_logger
+
+    file_handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    record_queue = queue.SimpleQueue()
+    trace_logger.addHandler(QueueHandler(record_queue))
+    QueueListener(record_queue, file_handler).start()
+    return trace_logger
+
+
+_trace_logger = _create_trace_logger()
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span | None", attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        # run_id, request_id 같은 속성은 부모 스팬에서 물려받습니다.
+        self.attributes = {**(parent.attributes if parent else {}), **attributes}
+        self.status = "ok"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    이름이 붙은 스팬을 열고, 끝나면 소요 시간과 함께 TRACE_FILE에 기록합니다.
+    관리자가 이 이름으로 프로파일링을 예약해 두었다면 스팬 구간을 프로파일링합니다.
+    """
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    profiler = _start_profiler(name, current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set(error=repr(e))
+        raise
+    finally:
+        if profiler:
+            _finish_profiler(profiler)
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        _export(current)
+
+
+def traced(name: str = None):
+    """함수 호출 전체를 스팬으로 감싸는 데코레이터."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes):
+    """현재 스팬에 속성(예: run_id)을 추가합니다. 이후 열리는 자식 스팬과 백그라운드 작업도 이를 물려받습니다."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def bind_context(func):
+    """
+    현재 트레이스 컨텍스트를 붙잡아 두었다가 func 실행 시 복원합니다.
+    BackgroundTasks나 run_in_executor로 넘기는 작업이 요청의 run_id/request_id를 이어받도록 사용합니다.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+    return wrapper
+
+
+def new_request_id() -> str:
+    return str(uuid.uuid4())
+
+
+# --- 내보내기 ---
+
+def _export(finished: Span):
+    if TRACE_EXPORT == "off":
+        return
+    record = _to_otlp(finished) if TRACE_EXPORT == "otlp" else _to_json(finished)
+    _trace_logger.info(orjson.dumps(record, default=str).decode("utf-8"))
+
+
+def _to_json(finished: Span) -> dict:
+    return {
+        "name": finished.name,
+        "trace_id": finished.trace_id,
+        "span_id": finished.span_id,
+        "parent_id": finished.parent_id,
+        "start": finished.start_ns / 1e9,
+        "duration_ms": round((finished.end_ns - finished.start_ns) / 1e6, 3),
+        "status": finished.status,
+        "attributes": finished.attributes,
+    }
+
+
+def _to_otlp(finished: Span) -> dict:
+    otlp_span = {
+        "traceId": finished.trace_id,
+        "spanId": finished.span_id,
+        "name": finished.name,
+        "kind": 1,
+        "startTimeUnixNano": str(finished.start_ns),
+        "endTimeUnixNano": str(finished.end_ns),
+        "attributes": [{"key": key, "value": {"stringValue": str(value)}} for key, value in finished.attributes.items()],
+        "status": {"code": 2 if finished.status == "error" else 1},
+    }
+    if finished.parent_id:
+        otlp_span["parentSpanId"] = finished.parent_id
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "airouge.tracing"}, "spans": [otlp_span]}],
+        }]
+    }
+
+
+# --- 관리자용 프로파일링 ---
+# 관리자가 스팬 이름(예: "get_floor_data", "calculate_floor_chart")으로 프로파일링을 예약하면,
+# 그 이름의 다음 스팬 한 번을 cProfile 또는 샘플링 방식으로 측정하고 보고서를 남깁니다.
+
+PROFILE_MODES = ("cprofile", "sampling")
+SAMPLING_INTERVAL = 0.005
+
+_profile_lock = threading.Lock()
+_armed_profiles = {}  # { 스팬 이름: 예약 정보 }
+_profile_reports = collections.OrderedDict()  # { profile_id: 예약 정보 + 보고서 }
+_MAX_PROFILE_REPORTS = 20
+
+
+def arm_profile(target: str, mode: str = "cprofile") -> dict:
+    """target 이름의 다음 스팬을 프로파일링하도록 예약합니다."""
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"지원하지 않는 프로파일링 방식입니다: {mode}")
+    profile = {
+        "profile_id": str(uuid.uuid4()),
+        "target": target,
+        "mode": mode,
+        "status": "armed",
+        "report": None,
+    }
+    with _profile_lock:
+        _armed_profiles[target] = profile
+        _profile_reports[profile["profile_id"]] = profile
+        while len(_profile_reports) > _MAX_PROFILE_REPORTS:
+            _profile_reports.popitem(last=False)
+    return _public(profile)
+
+
+def get_profile(profile_id: str) -> dict | None:
+    with _profile_lock:
+        profile = _profile_reports.get(profile_id)
+        return _public(profile) if profile else None
+
+
+def list_profiles() -> list:
+    with _profile_lock:
+        return [_public(profile) for profile in _profile_reports.values()]
+
+
+def _public(profile: dict) -> dict:
+    # 실행 중인 프로파일러 객체 같은 내부 값은 응답에서 제외합니다.
+    return {key: value for key, value in profile.items() if not key.startswith("_")}
+
+
+def _start_profiler(name: str, current: Span):
+    if not _armed_profiles:
+        return None
+    # 예약 정보는 get_profile/list_profiles가 같은 락 아래에서 읽으므로, 변경도 모두 락 안에서 합니다.
+    with _profile_lock:
+        profile = _armed_profiles.pop(name, None)
+        if profile is None:
+            return None
+
+        profile["status"] = "running"
+        profile["trace_id"] = current.trace_id
+        profile["attributes"] = dict(current.attributes)
+        if profile["mode"] == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # 다른 프로파일러가 이미 동작 중인 경우
+                profile["status"] = "failed"
+                profile["report"] = str(e)
+                return None
+            profile["_profiler"] = profiler
+        else:
+            sampler = _StackSampler(threading.get_ident())
+            sampler.start()
+            profile["_profiler"] = sampler
+        profile["_started"] = time.perf_counter()
+        return profile
+
+
+def _finish_profiler(profile: dict):
+    # 프로파일러 객체는 이 스레드만 다루므로, 보고서는 락 밖에서 만들고 결과 반영만 락 안에서 합니다.
+    profiler = profile["_profiler"]
+    elapsed = time.perf_counter() - profile["_started"]
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(40)
+        report = stream.getvalue()
+    else:
+        profiler.stop()
+        report = profiler.report()
+
+    with _profile_lock:
+        del profile["_profiler"]
+        del profile["_started"]
+        profile["duration_ms"] = round(elapsed * 1000, 3)
+        profile["report"] = report
+        profile["status"] = "completed"
+
+
+class _StackSampler(threading.Thread):
+    """대상 스레드의 호출 스택을 일정 간격으로 샘플링하는 통계적 프로파일러."""
+
+    def __init__(self, thread_id: int, interval: float = SAMPLING_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.total = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[tuple(reversed(stack))] += 1
+            self.total += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def report(self, limit: int = 20) -> str:
+        lines = [f"{self.total}개 샘플 (간격 {self.interval * 1000:.1f}ms)"]
+        for stack, count in self.samples.most_common(limit):
+            lines.append(f"\n{count} ({count / self.total:.1%})")
+            lines.extend(f"  {frame}" for frame in stack)
+        return "\n".join(lines)
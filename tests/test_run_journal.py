@@ -0,0 +1,111 @@
+import os
+import time
+
+from services.run_journal import RunJournal
+
+
+def _enemies():
+    return [{"id": str(i), "character_name": f"enemy_{i}"} for i in range(9)]
+
+
+def test_append_after_torn_tail_is_replayed(tmp_path):
+    journal = RunJournal(str(tmp_path))
+    journal.load()
+    journal.record_run_created("run_1", [{"name": "player"}], _enemies())
+    journal.close()
+
+    # 기록 도중 비정상 종료되어 마지막 줄이 잘린 상태를 만듭니다.
+    with open(journal.journal_path, "ab") as f:
+        f.write(b'{"op":"start","run_id":"run_1","flo')
+
+    journal = RunJournal(str(tmp_path))
+    runs = journal.load()
+    assert list(runs) == ["run_1"]
+    journal.record_run_created("run_2", [{"name": "player"}], _enemies())
+    journal.record_floor_started("run_2", 1)
+    journal.close()
+
+    journal = RunJournal(str(tmp_path))
+    runs = journal.load()
+    assert sorted(runs) == ["run_1", "run_2"]
+    assert journal.pending_floors() == [("run_2", 1)]
+    journal.close()
+
+
+def test_snapshot_then_journal_round_trip(tmp_path):
+    journal = RunJournal(str(tmp_path), snapshot_every=3)
+    runs = journal.load()
+    enemies = _enemies()
+    for run_id in ("run_1", "run_2"):
+        runs[run_id] = {"data": {"player_characters": [{"name": run_id}], "enemies": enemies, "type_charts": {}, "calculation_triggered": {}}}
+        journal.record_run_created(run_id, [{"name": run_id}], enemies)
+    runs["run_1"]["data"]["type_charts"]["1"] = {"player_vs_enemy": {"불": {"물": 0.5}}}
+    runs["run_1"]["data"]["calculation_triggered"][1] = True
+    # 세 번째 이벤트에서 압축이 시작되고, 이후 이벤트는 새 저널에 남습니다.
+    journal.record_floor_chart("run_1", 1, runs["run_1"]["data"]["type_charts"]["1"])
+    journal.record_floor_chart("run_2", 1, {"player_vs_enemy": {}})
+    journal.close()
+
+    assert os.path.exists(journal.snapshot_path)
+    assert not os.path.exists(journal.old_journal_path)
+
+    journal = RunJournal(str(tmp_path))
+    restored = journal.load()
+    assert sorted(restored) == ["run_1", "run_2"]
+    assert restored["run_1"]["data"]["enemies"] == enemies
+    assert restored["run_1"]["data"]["type_charts"]["1"] == {"player_vs_enemy": {"불": {"물": 0.5}}}
+    assert restored["run_2"]["data"]["type_charts"]["1"] == {"player_vs_enemy": {}}
+    assert restored["run_2"]["data"]["player_characters"] == [{"name": "run_2"}]
+    journal.close()
+
+    # 적 목록은 Run마다 반복되지 않고 캐릭터 레코드로 한 번만 저장됩니다.
+    with open(journal.snapshot_path, "rb") as f:
+        assert f.read().count(b'"character_name":"enemy_0"') == 1
+
+
+def test_complete_removes_run(tmp_path):
+    journal = RunJournal(str(tmp_path))
+    journal.load()
+    journal.record_run_created("run_1", [{"name": "player"}], _enemies())
+    journal.record_run_created("run_2", [{"name": "player"}], _enemies())
+    journal.record_run_completed("run_1")
+    journal.close()
+
+    journal = RunJournal(str(tmp_path))
+    assert list(journal.load()) == ["run_2"]
+    journal.close()
+
+
+def test_pending_floors_survive_compaction(tmp_path):
+    journal = RunJournal(str(tmp_path), snapshot_every=2)
+    runs = journal.load()
+    runs["run_1"] = {"data": {"player_characters": [], "enemies": _enemies(), "type_charts": {}, "calculation_triggered": {2: True}}}
+    journal.record_run_created("run_1", [], _enemies())
+    journal.record_floor_started("run_1", 2)
+    journal.close()
+
+    with open(journal.journal_path, "rb") as f:
+        assert f.read() == b""
+
+    journal = RunJournal(str(tmp_path))
+    journal.load()
+    assert journal.pending_floors() == [("run_1", 2)]
+    journal.close()
+
+
+def test_idle_runs_are_evicted_and_journaled(tmp_path):
+    journal = RunJournal(str(tmp_path), idle_ttl=60)
+    runs = journal.load()
+    for run_id in ("run_1", "run_2"):
+        runs[run_id] = {"data": {"player_characters": [], "enemies": _enemies(), "type_charts": {}, "calculation_triggered": {}}}
+        journal.record_run_created(run_id, [], _enemies())
+        journal.touch(runs[run_id])
+    runs["run_1"]["last_active"] = time.time() - 120
+
+    assert journal.evict_idle_runs() == ["run_1"]
+    assert list(runs) == ["run_2"]
+    journal.close()
+
+    journal = RunJournal(str(tmp_path), idle_ttl=60)
+    assert list(journal.load()) == ["run_2"]
+    journal.close()